@@ -1,17 +1,35 @@
+import concurrent.futures
 import cv2
+import numpy as np
 import requests
 import json
+import os
+import re
+import sqlite3
 import time
 from datetime import datetime
 import pygame
+import queue
 import threading
 from typing import Optional, Dict, Any, List
 import logging
 from dataclasses import dataclass
+from pyzbar.pyzbar import decode, ZBarSymbol
 
 # ============= CONFIGURACIÓN =============
 API_BASE_URL = "http://127.0.0.1:8000"  # Cambia por tu URL de API
+API_TIMEOUT = 2  # Segundos; un servidor caído no debe congelar el escáner
 CAMERA_INDEX = 1  # Índice de la cámara (0 para cámara principal)
+DB_LOCAL = "access_logs.db"  # Base de datos local de logs de acceso
+# En despliegues tipo kiosko (nadie mira la pantalla) definir QR_HEADLESS
+# suprime la ventana de previsualización y todo el trabajo de dibujo
+HEADLESS = bool(os.environ.get('QR_HEADLESS'))
+
+# Sesión HTTP compartida: reutiliza la conexión TCP con la API (keep-alive)
+# en lugar de abrir un socket nuevo por cada validación
+_SESSION = requests.Session()
+_SESSION.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=4))
 
 # Configuración de sonidos
 SOUND_SUCCESS = "success.wav"  # Archivo de sonido para éxito
@@ -28,6 +46,26 @@ logging.basicConfig(
     ]
 )
 
+# Payloads que no son credenciales y se descartan sin consultar la API:
+# configuraciones wifi y URLs/rutas de archivos de imagen. El filtro opera
+# sobre los bytes crudos que entrega pyzbar, así los códigos rechazados ni
+# siquiera pagan el decode utf-8
+_REJECT_RE = re.compile(rb'(?i)^\s*wifi:|\.(?:jpe?g|png|gif|bmp|webp)\b')
+_IMG_EXTS = (b'.jpg', b'.jpeg', b'.png', b'.gif', b'.bmp', b'.webp')
+
+def es_codigo_rechazado(data: bytes) -> bool:
+    """Indica si el payload crudo de un QR se descarta sin consultar la API"""
+    # Prefijo wifi: comparando solo los primeros bytes, sin pasar el payload
+    # completo por strip()/upper()
+    if data.lstrip()[:5].lower() == b'wifi:':
+        return True
+    # Caso común: la URL termina directamente en la extensión; solo se baja
+    # a minúsculas la cola de 5 bytes
+    if data[-5:].lower().endswith(_IMG_EXTS):
+        return True
+    # Resto de casos (extensión a mitad de URL)
+    return _REJECT_RE.search(data) is not None
+
 @dataclass
 class TokenValidation:
     """Clase para manejar la respuesta de validación de tokens"""
@@ -39,11 +77,75 @@ class TokenValidation:
     # Add new fields for attendance
     first_scan: Optional[bool] = None
     previous_scans: Optional[List[str]] = None
+    # Cache de las líneas ya formateadas para el overlay (se calculan una
+    # vez por validación, no en cada frame mostrado)
+    formatted_lines: Optional[List[str]] = None
+
+class CaptureThread(threading.Thread):
+    """Hilo productor que mantiene siempre disponible el frame más reciente.
+
+    Llama a grab() en un bucle cerrado para drenar el buffer del driver y
+    guarda el último frame decodificado en un slot único protegido por un
+    lock. Así la latencia de la cámara no depende de lo que tarde el bucle
+    principal (llamadas HTTP, sonido, dibujo del overlay).
+    """
+
+    def __init__(self, cap):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.latest = None
+        self.lock = threading.Lock()
+        self.new_frame = threading.Event()  # Hay un frame aún no consumido
+        self.stop_event = threading.Event()
+
+    def run(self):
+        retrieve_interval = 1.0 / 15  # Decodificar ~15 frames/s como máximo
+        last_retrieve = 0.0
+
+        while not self.stop_event.is_set():
+            # grab() avanza el stream sin decodificar; los frames que no
+            # llegan a retrieve() no pagan la conversión YUV->BGR
+            if not self.cap.grab():
+                break
+
+            current_time = time.time()
+            if current_time - last_retrieve < retrieve_interval:
+                continue
+            last_retrieve = current_time
+
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                continue
+
+            with self.lock:
+                self.latest = frame
+            self.new_frame.set()
+
+    def get_latest(self, timeout: float = 1.0):
+        """Espera el siguiente frame fresco y devuelve una copia.
+
+        Bloquea hasta que el productor deposite un frame nuevo (o venza el
+        timeout, devolviendo None): así cada iteración del bucle principal
+        corresponde a un frame capturado y el bucle hereda el ritmo de la
+        cámara, como hacía el cap.read() bloqueante.
+        """
+        if not self.new_frame.wait(timeout):
+            return None
+        with self.lock:
+            self.new_frame.clear()
+            if self.latest is None:
+                return None
+            return self.latest.copy()
+
+    def stop(self):
+        self.stop_event.set()
+        self.new_frame.set()  # Despertar a un consumidor bloqueado
+
 
 class QRScanner:
     def __init__(self):
         self.cap = None
-        self.detector = cv2.QRCodeDetector()
+        self.capture_thread = None
         self.last_scanned_token = ""
         self.last_scan_time = 0
         self.scan_cooldown = 3  # Segundos entre escaneos del mismo token
@@ -52,39 +154,113 @@ class QRScanner:
         self.current_display_validation = None # Stores the validation for display
         self.info_display_time = 0
         self.info_duration = 5 # Seconds to display information
+        self.detect_scale = 0.5  # Detectar sobre la imagen reducida a la mitad
+        # El bucle va al ritmo de CaptureThread (~15fps) -> ~3 detecciones/s
+        self.detect_interval = 5
+        self._frame_count = 0
+        self._detect_burst = 0  # Frames restantes de muestreo agresivo
+        self._frames_sin_deteccion = 0
+        self._gray_buf = None  # Buffer reutilizable para la conversión a gris
+        self._last_sig = None  # Huella del último frame analizado
+        self._frames_estaticos = 0
+        self._overlay_strip = None  # Fondo negro reutilizable del cuadro de info
+
+        # Etiquetas fijas pre-renderizadas: putText rasteriza los glifos por
+        # CPU en cada llamada, así que los textos que nunca cambian se
+        # dibujan una sola vez y luego solo se blitean sobre el frame
+        self._label_titulo = self._render_label(
+            "Escaner QR - Control de Asistencia", 0.7, (255, 255, 255), 2)
+        self._label_teclas = self._render_label(
+            "Presiona 'q' para salir, 's' para sonido", 0.5, (255, 255, 255), 1)
+        self._label_sonido = {
+            True: self._render_label("Sonido: ON", 0.6, (0, 255, 0), 2),
+            False: self._render_label("Sonido: OFF", 0.6, (0, 0, 255), 2),
+        }
+
+        # Las llamadas HTTP se procesan en un worker para no congelar el
+        # bucle de captura durante los (hasta 10s de) timeout de la API
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._pending_validation: Optional[concurrent.futures.Future] = None
         
         # Inicializar pygame para sonidos
+        self._sounds = {}
         try:
             pygame.mixer.init()
+            # Pre-cargar los wav una vez; mixer.music.load releía y parseaba
+            # el archivo desde disco en cada reproducción
+            for sound_type, sound_file in (("success", SOUND_SUCCESS),
+                                           ("error", SOUND_ERROR),
+                                           ("warning", SOUND_WARNING)):
+                try:
+                    self._sounds[sound_type] = pygame.mixer.Sound(sound_file)
+                except Exception as e:
+                    logging.warning(f"No se pudo cargar el sonido {sound_file}: {e}")
             logging.info("Sistema de sonido inicializado")
         except Exception as e:
             logging.warning(f"No se pudo inicializar el sistema de sonido: {e}")
             self.sound_enabled = False
+
+        # Los sonidos se reproducen desde un hilo propio alimentado por una
+        # cola, para que el mixer nunca frene al hilo que detecta o valida
+        self._sound_queue = queue.Queue()
+        self._sound_thread = threading.Thread(target=self._sound_worker,
+                                              daemon=True)
+        self._sound_thread.start()
     
     def play_sound(self, sound_type: str):
-        """Reproduce sonidos según el resultado de la validación"""
+        """Encola un sonido según el resultado de la validación"""
         if not self.sound_enabled:
             return
-        
-        try:
-            sound_files = {
-                "success": SOUND_SUCCESS,
-                "error": SOUND_ERROR,
-                "warning": SOUND_WARNING
-            }
-            
-            sound_file = sound_files.get(sound_type)
-            if sound_file:
-                pygame.mixer.music.load(sound_file)
-                pygame.mixer.music.play()
-        except Exception as e:
-            logging.warning(f"Error reproduciendo sonido {sound_type}: {e}")
+
+        self._sound_queue.put(sound_type)
+
+    def _sound_worker(self):
+        """Consume la cola de sonidos y los reproduce en su propio hilo"""
+        while True:
+            sound_type = self._sound_queue.get()
+            if sound_type is None:
+                break
+
+            sound = self._sounds.get(sound_type)
+            if sound is None:
+                continue
+
+            try:
+                sound.play()
+            except Exception as e:
+                logging.warning(f"Error reproduciendo sonido {sound_type}: {e}")
     
+    def _render_label(self, text: str, scale: float, color: tuple,
+                      thickness: int) -> tuple:
+        """Pre-renderiza una etiqueta fija en un sprite pequeño.
+
+        Devuelve (imagen, máscara de píxeles con texto, altura del texto)
+        para blitear con el mismo origen de línea base que usa putText.
+        """
+        (w, h), base = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX,
+                                       scale, thickness)
+        img = np.zeros((h + base, w, 3), np.uint8)
+        cv2.putText(img, text, (0, h), cv2.FONT_HERSHEY_SIMPLEX,
+                    scale, color, thickness)
+        # Máscara colapsada por píxel (no por canal): un píxel con texto se
+        # copia entero, incluidos sus canales a cero; con img > 0 a secas el
+        # indicador verde/rojo dejaría pasar el fondo en los otros canales
+        return img, (img > 0).any(axis=2, keepdims=True), h
+
+    def _blit_label(self, frame, label: tuple, org: tuple):
+        """Copia un sprite pre-renderizado sobre el frame (org = línea base)"""
+        img, mask, ascent = label
+        x, y = org
+        top = max(y - ascent, 0)
+        roi = frame[top:top + img.shape[0], x:x + img.shape[1]]
+        np.copyto(roi, img[:roi.shape[0], :roi.shape[1]],
+                  where=mask[:roi.shape[0], :roi.shape[1]])
+
     def validate_token_api(self, token: str) -> TokenValidation:
         """Valida el token usando la API mejorada"""
         try:
             url = f"{API_BASE_URL}/tokens/{token}/validate"
-            response = requests.get(url, timeout=10)
+            response = _SESSION.get(url, timeout=API_TIMEOUT)
             
             if response.status_code == 200:
                 data = response.json()
@@ -137,7 +313,7 @@ class QRScanner:
         """Marca el token como usado en la API, registrando la asistencia"""
         try:
             url = f"{API_BASE_URL}/tokens/{token}/record_scan"
-            response = requests.post(url, timeout=10)
+            response = _SESSION.post(url, timeout=API_TIMEOUT)
             
             if response.status_code == 200:
                 return response.json()
@@ -163,7 +339,15 @@ class QRScanner:
             return (0, 0, 255)  # Rojo para error o estados desconocidos
     
     def format_token_info(self, validation: TokenValidation) -> list:
-        """Formatea la información del token para mostrar"""
+        """Formatea la información del token para mostrar.
+
+        El resultado se cachea en la validación: mientras dura el overlay
+        (~5s a 15fps) se llamaría decenas de veces re-parseando con
+        datetime.fromisoformat cada timestamp de previous_scans.
+        """
+        if validation.formatted_lines is not None:
+            return validation.formatted_lines
+
         info_lines = []
         
         info_lines.append(f"Estado: {validation.estado}")
@@ -205,24 +389,32 @@ class QRScanner:
                     info_lines.append(f"Expira: {expira_en.strftime('%d/%m/%Y %H:%M')}")
                 except:
                     info_lines.append(f"Expira: {data['expira_en']}")
-        
+
+        validation.formatted_lines = info_lines
         return info_lines
     
-    def process_token(self, token: str) -> Optional[TokenValidation]:
-        """Procesa un token escaneado"""
+    def process_token(self, token: str):
+        """Encola el procesamiento de un token escaneado sin bloquear el bucle"""
         current_time = time.time()
-        
+
         # Verificar cooldown para evitar múltiples escaneos rápidos del MISMO token
-        if (token == self.last_scanned_token and 
+        if (token == self.last_scanned_token and
             current_time - self.last_scan_time < self.scan_cooldown):
             # If still in cooldown for the same token, don't re-process or update display
-            return None # Do not update current_display_validation
-        
+            return # Do not update current_display_validation
+
         self.last_scanned_token = token
         self.last_scan_time = current_time
-        
+
         logging.info(f"Token escaneado: {token[:8]}...")
-        
+
+        # Las llamadas a la API corren en el worker; el resultado se recoge
+        # en el bucle principal cuando el future termina
+        self._pending_validation = self._executor.submit(
+            self._validate_and_record, token)
+
+    def _validate_and_record(self, token: str) -> TokenValidation:
+        """Registra el escaneo y valida el token contra la API (hilo worker)"""
         # 1. First, record the scan for attendance
         scan_record_result = self.record_scan_api(token)
         
@@ -257,18 +449,31 @@ class QRScanner:
             # The message and state are already set by validate_token_api
 
         logging.info(f"Resultado final: {validation.estado} - {validation.message}")
-        
+
+        guardar_log_acceso(token, validation.estado, validation.valid,
+                           validation.token_data)
+
         return validation
     
     def initialize_camera(self) -> bool:
         """Inicializa la cámara"""
         try:
             self.cap = cv2.VideoCapture(CAMERA_INDEX)
-            
+
             if not self.cap.isOpened():
                 logging.error(f"No se pudo abrir la cámara {CAMERA_INDEX}")
                 return False
-            
+
+            # Reducir el buffer del driver a 1 frame para evitar leer
+            # frames atrasados después de una pausa en el bucle
+            if not self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1):
+                logging.warning("El driver de la cámara no soporta CAP_PROP_BUFFERSIZE")
+
+            # Pedir MJPEG al driver (las cámaras USB UVC entregan más FPS
+            # con frames ya comprimidos que con YUYV crudo)
+            if not self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG')):
+                logging.warning("El driver de la cámara no aceptó el formato MJPG")
+
             # Configurar resolución para mejor rendimiento
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
@@ -295,60 +500,166 @@ class QRScanner:
         print("- Ideal para control de entradas y salidas.")
         print("==========================================")
         
+        self.capture_thread = CaptureThread(self.cap)
+        self.capture_thread.start()
+
+        last_shown = 0.0
+
         try:
             while self.running:
-                ret, frame = self.cap.read()
-                
-                if not ret:
-                    logging.error("Error capturando frame de la cámara")
-                    break
-                
-                # Detectar códigos QR
-                data, bbox, _ = self.detector.detectAndDecode(frame)
-                
-                if data:
-                    # Process the token and update display validation if new
-                    new_validation = self.process_token(data)
-                    if new_validation: # Only update if it's not a cooldown bypass
-                        self.current_display_validation = new_validation
+                frame = self.capture_thread.get_latest()
+
+                if frame is None:
+                    if not self.capture_thread.is_alive():
+                        logging.error("Error capturando frame de la cámara")
+                        break
+                    # Timeout esperando un frame fresco; reintentar
+                    continue
+
+                # Detectar códigos QR. zbar trabaja solo sobre luminancia:
+                # convertir una vez con la ruta SIMD de OpenCV es más barato
+                # que dejar que lo haga internamente sobre los 3 canales BGR
+                # Convertir a gris sobre un buffer reutilizado para no
+                # reservar 300KB nuevos por frame
+                if (self._gray_buf is None or
+                        self._gray_buf.shape != frame.shape[:2]):
+                    self._gray_buf = np.empty(frame.shape[:2], np.uint8)
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY,
+                                    dst=self._gray_buf)
+
+                self._frame_count += 1
+
+                # La ventana se refresca como mucho a 5fps de reloj aunque
+                # la captura y la detección sigan a ritmo completo; en modo
+                # headless no se dibuja nada
+                mostrar = (not HEADLESS and
+                           time.time() - last_shown >= 0.2)
+                if mostrar:
+                    last_shown = time.time()
+
+                # Huella barata de la escena: si el frame es prácticamente
+                # idéntico al anterior no hay nada nuevo que decodificar
+                # (lo habitual en un lector de acceso, que pasa casi todo el
+                # tiempo mirando una escena vacía). Cada ~15 frames se fuerza
+                # una detección por si el fingerprint no capta un QR quieto
+                tiny = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+                sig = tiny.tobytes()
+                escena_estatica = (sig == self._last_sig and
+                                   self._frames_estaticos < 15)
+                # Racha estática expirada: detección forzada en este frame,
+                # sin esperar a que coincida con el muestreo periódico
+                forzar = sig == self._last_sig and not escena_estatica
+                if escena_estatica:
+                    self._frames_estaticos += 1
+                else:
+                    self._last_sig = sig
+                    self._frames_estaticos = 0
+
+                # Aunque la escena cambie, con ~3 detecciones/s alcanza para
+                # responder en <100ms a un código sostenido; tras un acierto
+                # se muestrea cada frame durante una ventana corta
+                if self._detect_burst > 0:
+                    self._detect_burst -= 1
+                    muestrear = True
+                else:
+                    muestrear = self._frame_count % self.detect_interval == 0
+
+                codigos = []
+                escala = 1.0
+
+                if (muestrear or forzar) and not escena_estatica:
+                    # Detectar sobre la imagen reducida: un cuarto de los
+                    # píxeles para el decodificador; la resolución completa
+                    # solo se usa para dibujar (y como reintento si el QR
+                    # queda muy chico)
+                    small = cv2.resize(gray, None, fx=self.detect_scale,
+                                       fy=self.detect_scale,
+                                       interpolation=cv2.INTER_AREA)
+                    codigos = decode(small, symbols=[ZBarSymbol.QRCODE])
+                    escala = 1.0 / self.detect_scale
+
+                    if not codigos:
+                        self._frames_sin_deteccion += 1
+                        if self._frames_sin_deteccion % 15 == 0:
+                            # Reintento a resolución completa por si el código
+                            # es demasiado pequeño para la imagen reducida
+                            codigos = decode(gray, symbols=[ZBarSymbol.QRCODE])
+                            escala = 1.0
+
+                    if codigos:
+                        self._frames_sin_deteccion = 0
+                        self._detect_burst = 30
+
+                for qr in codigos:
+                    # Filtrar sobre los bytes crudos: el decode utf-8 solo
+                    # se paga para los payloads aceptados
+                    if not es_codigo_rechazado(qr.data):
+                        data = qr.data.decode('utf-8', errors='replace')
+
+                        if data:
+                            self.process_token(data)
+
+                    if mostrar:
+                        # Dibujar el contorno del QR detectado, reescalado a
+                        # las coordenadas del frame completo
+                        pts = (np.array([(p.x, p.y) for p in qr.polygon])
+                               * escala).astype(np.int32)
+                        cv2.polylines(frame, [pts], True, (255, 0, 255), 2)
+
+                # Recoger el resultado de la validación en curso sin bloquear
+                if self._pending_validation and self._pending_validation.done():
+                    try:
+                        self.current_display_validation = self._pending_validation.result()
                         self.info_display_time = time.time()
+                    except Exception as e:
+                        logging.error(f"Error procesando token: {e}")
+                    self._pending_validation = None
                 
-                # Dibujar el bbox si se detectó un QR
-                if bbox is not None:
-                    bbox = bbox.astype(int)
-                    cv2.polylines(frame, [bbox], True, (255, 0, 255), 2)
-                
-                # Mostrar información del último token validado
-                if (self.current_display_validation and 
-                    time.time() - self.info_display_time < self.info_duration):
-                    
-                    color = self.get_display_color(self.current_display_validation)
-                    info_lines = self.format_token_info(self.current_display_validation)
-                    
-                    # Fondo semi-transparente para mejor legibilidad
-                    overlay = frame.copy()
-                    cv2.rectangle(overlay, (10, 10), (450, 25 + len(info_lines) * 25), (0, 0, 0), -1)
-                    cv2.addWeighted(overlay, 0.7, frame, 0.3, 0, frame)
-                    
-                    # Mostrar información línea por línea
-                    for i, line in enumerate(info_lines):
-                        y_pos = 30 + i * 25
-                        cv2.putText(frame, line, (15, y_pos), 
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-                
-                # Mostrar instrucciones
-                cv2.putText(frame, "Escaner QR - Control de Asistencia", (10, frame.shape[0] - 60), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                cv2.putText(frame, "Presiona 'q' para salir, 's' para sonido", (10, frame.shape[0] - 30), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                
-                # Mostrar estado del sonido
-                sound_status = "ON" if self.sound_enabled else "OFF"
-                cv2.putText(frame, f"Sonido: {sound_status}", (frame.shape[1] - 120, 30), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0) if self.sound_enabled else (0, 0, 255), 2)
-                
-                cv2.imshow('Escáner QR - Control de Asistencia', frame)
-                
+                if mostrar:
+                    # Mostrar información del último token validado
+                    if (self.current_display_validation and
+                        time.time() - self.info_display_time < self.info_duration):
+
+                        color = self.get_display_color(self.current_display_validation)
+                        info_lines = self.format_token_info(self.current_display_validation)
+
+                        # Fondo semi-transparente para mejor legibilidad: se
+                        # mezcla solo el ROI del cuadro de texto contra una
+                        # franja negra reutilizada, en lugar de copiar y
+                        # mezclar el frame completo (~920KB) en cada iteración
+                        y1 = min(25 + len(info_lines) * 25, frame.shape[0])
+                        x1 = min(450, frame.shape[1])
+                        roi = frame[10:y1, 10:x1]
+                        if (self._overlay_strip is None or
+                                self._overlay_strip.shape[0] < roi.shape[0] or
+                                self._overlay_strip.shape[1] < roi.shape[1]):
+                            self._overlay_strip = np.zeros(roi.shape, np.uint8)
+                        strip = self._overlay_strip[:roi.shape[0], :roi.shape[1]]
+                        frame[10:y1, 10:x1] = cv2.addWeighted(strip, 0.7, roi, 0.3, 0)
+
+                        # Mostrar información línea por línea
+                        for i, line in enumerate(info_lines):
+                            y_pos = 30 + i * 25
+                            cv2.putText(frame, line, (15, y_pos),
+                                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+                    # Mostrar instrucciones
+                    self._blit_label(frame, self._label_titulo,
+                                     (10, frame.shape[0] - 60))
+                    self._blit_label(frame, self._label_teclas,
+                                     (10, frame.shape[0] - 30))
+
+                    # Mostrar estado del sonido
+                    self._blit_label(frame, self._label_sonido[self.sound_enabled],
+                                     (frame.shape[1] - 120, 30))
+
+                    cv2.imshow('Escáner QR - Control de Asistencia', frame)
+
+                if HEADLESS:
+                    # get_latest() ya marca el ritmo del bucle; sin ventana
+                    # solo queda salir con Ctrl+C o bajando self.running
+                    continue
+
                 # Manejar teclas
                 key = cv2.waitKey(1) & 0xFF
                 if key == ord('q'):
@@ -368,21 +679,192 @@ class QRScanner:
     def cleanup(self):
         """Limpia los recursos"""
         self.running = False
-        
+
+        if self.capture_thread:
+            self.capture_thread.stop()
+            self.capture_thread.join(timeout=2)
+
+        self._executor.shutdown(wait=False)
+
         if self.cap:
             self.cap.release()
         
         cv2.destroyAllWindows()
-        
+
+        # Detener el hilo de sonido y esperarlo antes de apagar el mixer,
+        # para que un play() encolado no corra contra mixer.quit()
+        self._sound_queue.put(None)
+        self._sound_thread.join(timeout=2)
+
         if self.sound_enabled:
             pygame.mixer.quit()
         
         logging.info("Escáner cerrado correctamente")
 
+# ============= BASE DE DATOS LOCAL =============
+
+_db_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()  # Serializa el acceso a la conexión compartida
+
+_pending_logs: List[tuple] = []  # Registros pendientes de volcar a la base
+_flush_thread: Optional[threading.Thread] = None
+FLUSH_INTERVAL = 0.5  # Segundos entre volcados del buffer de logs
+
+_INSERT_LOG_SQL = '''INSERT INTO access_logs
+    (timestamp, token_data, validation_result, access_granted, response_data)
+    VALUES (?, ?, ?, ?, ?)'''
+
+# Codificador JSON compacto reutilizable (evita recrear el encoder y los
+# espacios separadores de json.dumps en cada registro)
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+def get_conn():
+    """Devuelve la conexión compartida a la base local, abriéndola si no existe.
+
+    Reutilizar una sola conexión evita re-parsear el esquema y pagar el
+    fsync de cierre en cada log; abrir/cerrar por INSERT bloqueaba el bucle
+    de escaneo varios milisegundos por registro.
+    """
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(DB_LOCAL, check_same_thread=False,
+                               cached_statements=128)
+        # WAL evita los dos fsync por transacción del rollback journal y
+        # permite leer sin bloquear las escrituras del escáner
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _db_conn = conn
+    return _db_conn
+
+def _volcar_logs_pendientes():
+    """Vuelca los registros acumulados a la base en una sola transacción.
+
+    Agrupar los INSERT en un BEGIN/COMMIT colapsa los fsync de una ráfaga
+    de escaneos en uno solo; la durabilidad queda acotada a FLUSH_INTERVAL.
+    """
+    global _pending_logs
+    try:
+        with _db_lock:
+            if not _pending_logs:
+                return
+            pendientes, _pending_logs = _pending_logs, []
+            conn = get_conn()
+            with conn:
+                conn.executemany(_INSERT_LOG_SQL, pendientes)
+    except Exception as e:
+        logging.error(f"Error volcando logs pendientes: {e}")
+
+def _iniciar_flush_logs():
+    """Arranca el hilo que vuelca el buffer de logs periódicamente"""
+    global _flush_thread
+    if _flush_thread is not None:
+        return
+
+    def _bucle_flush():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            _volcar_logs_pendientes()
+
+    _flush_thread = threading.Thread(target=_bucle_flush, daemon=True)
+    _flush_thread.start()
+
+def cerrar_db_local():
+    """Vuelca los logs pendientes y cierra la conexión compartida"""
+    global _db_conn
+    _volcar_logs_pendientes()
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.commit()
+            _db_conn.close()
+            _db_conn = None
+
+def inicializar_db_local():
+    """Crea la base de datos local de logs de acceso si no existe"""
+    try:
+        with _db_lock:
+            conn = get_conn()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS access_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    token_data TEXT NOT NULL,
+                    validation_result TEXT NOT NULL,
+                    access_granted BOOLEAN NOT NULL,
+                    response_data TEXT,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Índices para que las estadísticas y el listado de recientes no
+            # recorran la tabla completa a medida que crecen los logs
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_granted
+                            ON access_logs(access_granted)''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_id_desc
+                            ON access_logs(id DESC)''')
+            conn.commit()
+        _iniciar_flush_logs()
+        logging.info("Base de datos local inicializada")
+        return True
+    except Exception as e:
+        logging.error(f"Error inicializando la base de datos local: {e}")
+        return False
+
+def guardar_log_acceso(token: str, validation_result: str, access_granted: bool,
+                       response_data: Optional[Dict[str, Any]] = None):
+    """Encola un registro de acceso para el próximo volcado a la base local"""
+    with _db_lock:
+        _pending_logs.append((
+            datetime.now().isoformat(),
+            token,
+            validation_result,
+            access_granted,
+            _json_encode(response_data) if response_data else None
+        ))
+
+def mostrar_logs_recientes(limite: int = 10):
+    """Muestra los últimos registros de acceso de la base local"""
+    try:
+        _volcar_logs_pendientes()
+        with _db_lock:
+            filas = get_conn().execute(
+                '''SELECT timestamp, token_data, validation_result, access_granted
+                   FROM access_logs ORDER BY id DESC LIMIT ?''',
+                (limite,)
+            ).fetchall()
+
+        if not filas:
+            print("No hay registros de acceso")
+            return
+
+        print(f"\n=== Últimos {len(filas)} registros de acceso ===")
+        for timestamp, token, resultado, concedido in filas:
+            icono = "✅" if concedido else "❌"
+            print(f"{icono} {timestamp} - {token[:8]}... - {resultado}")
+    except Exception as e:
+        logging.error(f"Error consultando logs recientes: {e}")
+
+def obtener_estadisticas() -> Dict[str, int]:
+    """Obtiene estadísticas de accesos de la base local"""
+    try:
+        _volcar_logs_pendientes()
+        with _db_lock:
+            # Una sola pasada con agregación condicional en lugar de tres
+            # COUNT separados sobre la tabla completa
+            total, concedidos, denegados = get_conn().execute(
+                '''SELECT COUNT(*),
+                          COALESCE(SUM(CASE WHEN access_granted = 1 THEN 1 ELSE 0 END), 0),
+                          COALESCE(SUM(CASE WHEN access_granted = 0 THEN 1 ELSE 0 END), 0)
+                   FROM access_logs'''
+            ).fetchone()
+        return {"total": total, "concedidos": concedidos, "denegados": denegados}
+    except Exception as e:
+        logging.error(f"Error consultando estadísticas: {e}")
+        return {"total": 0, "concedidos": 0, "denegados": 0}
+
 def check_api_connection():
     """Verifica la conexión con la API"""
     try:
-        response = requests.get(f"{API_BASE_URL}/info", timeout=5)
+        response = _SESSION.get(f"{API_BASE_URL}/info", timeout=5)
         if response.status_code == 200:
             data = response.json()
             print(f"✅ Conectado a: {data.get('app', 'QR Token API')}")
@@ -404,8 +886,13 @@ def check_api_connection():
 def main():
     """Función principal"""
     print("=== Escáner QR - Sistema de Control de Asistencia ===")
+    print("Inicializando base de datos local...")
+
+    if not inicializar_db_local():
+        print("⚠️  No se pudo inicializar la base de datos local de logs.")
+
     print("Verificando conexión con la API...")
-    
+
     if not check_api_connection():
         print("\n⚠️  No se pudo conectar con la API.")
         print("   Asegúrate de que la API esté ejecutándose.")
@@ -416,5 +903,13 @@ def main():
     scanner = QRScanner()
     scanner.run()
 
+    stats = obtener_estadisticas()
+    print(f"\n📊 Accesos registrados: {stats['total']} "
+          f"(✅ {stats['concedidos']} / ❌ {stats['denegados']})")
+    mostrar_logs_recientes(5)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        cerrar_db_local()
\ No newline at end of file